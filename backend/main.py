@@ -4,27 +4,45 @@ FastAPI Backend — pydantic-ai agents for structured Gemini output
 
 Pipeline:
   1. Receive PDF in-memory (never touches disk)
-  2. Convert pages → PNG images via pypdfium2
+  2. Convert pages → JPEG images via pypdfium2, streamed into step 3 as they render
   3. pydantic-ai Agent[ExtractionResult]  →  typed transaction list
+     (one concurrent call per chunk of pages, merged in page order)
   4. pydantic-ai Agent[ClassificationResult]  →  categorised transaction list
   5. Pure-Python analytics (idle cash, subscriptions, category summary)
-  6. Return AnalysisResponse
+  6. Return AnalysisResponse (or stream it as NDJSON from /api/analyze/stream)
 """
 
+import asyncio
+import hashlib
 import io
+import math
 import os
+import re
+import sys
 import logging
+import httpx
+import threading
+import time
+import orjson
 import pypdfium2 as pdfium
-from collections import defaultdict
-from datetime import datetime
-from typing import Optional
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from functools import lru_cache
+from statistics import median
+from typing import Callable, Generator, Optional
 
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from pydantic.json_schema import SkipJsonSchema
 from pydantic_ai import Agent, BinaryContent
 from pydantic_ai.models.gemini import GeminiModel
+from pydantic_ai.providers.google_gla import GoogleGLAProvider
 from pydantic_ai.settings import ModelSettings
+from pydantic_ai.usage import Usage
 
 # ─── Logging ──────────────────────────────────────────────────────────────────
 logging.basicConfig(level=logging.INFO, format="%(asctime)s  %(levelname)s  %(message)s")
@@ -35,14 +53,41 @@ log = logging.getLogger("ledger")
 GEMINI_MODEL_NAME = "gemini-3-flash-preview"   # free-tier model
 SAFETY_BUFFER_PCT = 0.20
 MAX_PDF_SIZE_MB   = 20
-IMAGE_DPI         = 150
+UPLOAD_CHUNK_SIZE = 1 << 20  # bytes read per step while receiving an upload
+IMAGE_DPI         = 110
+MAX_IMAGE_DPI     = 150    # used instead for pages with very small print
+MAX_IMAGE_EDGE_PX = 1800   # longest edge of a rendered page; A4 / Letter still fit at MAX_IMAGE_DPI
+SMALL_FONT_PT     = 7      # median font size (pt) at or below which a page counts as small print
+JPEG_QUALITY      = 85
+PAGES_PER_CHUNK   = 3      # pages sent per extraction call
+MAX_LLM_INFLIGHT  = 8      # process-wide cap on concurrent Gemini requests
+STREAM_DEBOUNCE_S = 0.05   # how often partial extraction output is re-validated
+
+# Results cache for repeat uploads of the same PDF. Holding results in memory
+# is a form of retention, so it stays off unless RESULT_CACHE_TTL_S is set.
+RESULT_CACHE_TTL_S = int(os.environ.get("RESULT_CACHE_TTL_S", "0"))
+RESULT_CACHE_SIZE  = 256
 
 # os.environ["GEMINI_API_KEY"]=GEMINI_API_KEY
 os.environ["GEMINI_MODEL_NAME"]=GEMINI_MODEL_NAME
 GEMINI_API_KEY = os.environ["GEMINI_API_KEY"]
 
 # ─── FastAPI ──────────────────────────────────────────────────────────────────
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Attach the one shared Gemini model to both agents up front
+    model = None
+    if GEMINI_API_KEY:
+        model = _make_model()
+        extraction_agent.model = classification_agent.model = model
+    yield
+    if model is not None:
+        await model.client.aclose()
+        _make_model.cache_clear()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Ledger API",
     description="AI-powered bank statement analysis. Zero data retention.",
     version="2.0.0",
@@ -59,12 +104,24 @@ app.add_middleware(
 # PYDANTIC MODELS — shared between AI agents and API response
 # ══════════════════════════════════════════════════════════════════════════════
 
-class RawTransaction(BaseModel):
+class Transaction(BaseModel):
+    """API row model (unchanged shape — frontend doesn't need to change)."""
+    date:     str
+    desc:     str
+    amount:   float
+    type:     str
+    category: Optional[str] = None
+
+
+# Subclasses the API row so extracted rows go into the response as-is;
+# `category` is hidden from the agent's schema and filled in place by Stage 2.
+class RawTransaction(Transaction):
     """Output schema for Stage 1 — extraction agent."""
-    date:   str   = Field(description="Transaction date in YYYY-MM-DD format")
-    desc:   str   = Field(description="Merchant name or transaction description")
-    amount: float = Field(gt=0, description="Positive transaction amount")
-    type:   str   = Field(description="Exactly 'Debit' or 'Credit'")
+    date:     str   = Field(description="Transaction date in YYYY-MM-DD format")
+    desc:     str   = Field(description="Merchant name or transaction description")
+    amount:   float = Field(gt=0, description="Positive transaction amount")
+    type:     str   = Field(description="Exactly 'Debit' or 'Credit'")
+    category: SkipJsonSchema[Optional[str]] = None
 
 
 class ExtractionResult(BaseModel):
@@ -76,11 +133,8 @@ class ExtractionResult(BaseModel):
 
 class CategorisedTransaction(BaseModel):
     """Output schema for Stage 2 — classification agent."""
-    date:     str   = Field(description="Transaction date YYYY-MM-DD")
-    desc:     str   = Field(description="Merchant name or description")
-    amount:   float = Field(gt=0, description="Positive transaction amount")
-    type:     str   = Field(description="Exactly 'Debit' or 'Credit'")
-    category: str   = Field(description="AI-assigned lifestyle bucket name")
+    idx:      int = Field(description="Index of the transaction in the input list")
+    category: str = Field(description="AI-assigned lifestyle bucket name")
 
 
 class ClassificationResult(BaseModel):
@@ -89,18 +143,11 @@ class ClassificationResult(BaseModel):
         description="The 5-8 lifestyle bucket names invented for this person"
     )
     transactions: list[CategorisedTransaction] = Field(
-        description="All transactions with category assigned"
+        description="Every input transaction index with its category"
     )
 
 
 # API response models (unchanged shape — frontend doesn't need to change)
-class Transaction(BaseModel):
-    date:     str
-    desc:     str
-    amount:   float
-    type:     str
-    category: Optional[str] = None
-
 class IdleCash(BaseModel):
     monthly_burn:       float
     total_income:       float
@@ -129,20 +176,38 @@ class AnalysisResponse(BaseModel):
     period:            Optional[str] = None
 
 
+# Whole-list validators: one pydantic-core call per list instead of one per row
+_CATEGORY_LIST     = TypeAdapter(list[CategorySummary])
+_SUBSCRIPTION_LIST = TypeAdapter(list[SubscriptionItem])
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # PYDANTIC-AI AGENTS
 # ══════════════════════════════════════════════════════════════════════════════
 
+@lru_cache(maxsize=1)
 def _make_model() -> GeminiModel:
-    """Build GeminiModel — fails fast if no API key is set."""
+    """Build the shared GeminiModel — fails fast if no API key is set.
+
+    Cached so every call reuses one pooled HTTP/2 client instead of paying a
+    fresh TCP+TLS handshake; concurrent extraction calls multiplex over it.
+    """
     if not GEMINI_API_KEY:
         raise RuntimeError("GEMINI_API_KEY not set in environment.")
-    return GeminiModel(GEMINI_MODEL_NAME)
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20),
+        timeout=httpx.Timeout(600, connect=5),
+    )
+    return GeminiModel(
+        GEMINI_MODEL_NAME,
+        provider=GoogleGLAProvider(api_key=GEMINI_API_KEY, http_client=http_client),
+    )
 
 
 # ── Agent 1: Extraction ────────────────────────────────────────────────────────
 extraction_agent = Agent(
-    model=None,   # set lazily on first use so startup doesn't fail without a key
+    model=None,   # set in lifespan() so startup doesn't fail without a key
     result_type=ExtractionResult,
     system_prompt=(
         "You are a financial document parser specialising in Indian bank statements. "
@@ -172,58 +237,309 @@ classification_agent = Agent(
         "'Online Shopping', 'Family Remittances', 'Insurance & Protection'\n\n"
         "2. Assign every transaction exactly one category from your invented set.\n\n"
         "Return categories_used (the list of bucket names you created) and "
-        "transactions (every transaction with its category field filled in)."
+        "transactions (the index of every transaction with its category)."
     ),
     model_settings=ModelSettings(temperature=0.1, max_tokens=8192),
 )
 
 
+# ── Static prompt prefixes ─────────────────────────────────────────────────────
+# Gemini implicitly caches a repeated prompt *prefix* (≥ ~1k tokens) across
+# requests. These blocks are byte-identical on every call and always sent
+# before any per-statement content, so that prefix is shared by every user.
+
+EXTRACTION_INSTRUCTIONS = (
+    "The images that follow are consecutive pages of one bank statement. "
+    "Read every table row on them. Extract every transaction and return them "
+    "in the required structured format."
+)
+
+CLASSIFICATION_PRIMER = """\
+Reference notes for classifying Indian bank transactions.
+
+How to read a transaction description:
+- UPI narrations look like "UPI/<ref>/<payee>/<bank>" or "UPI-<payee>-<vpa>@<bank>"; the payee is the merchant.
+- "NEFT", "IMPS" and "RTGS" prefixes are bank transfers; the counterparty name follows the reference number.
+- "ACH D-", "NACH" and "ECS" debits are mandates: SIPs, loan EMIs, insurance premiums or utility autopay.
+- "POS" and "ECOM" prefixes are card payments at a store or website; the merchant name follows.
+- "ATM WDL" / "ATW" / "NWD" is a cash withdrawal.
+- "INT.PD", "INT CR" or "Interest" credits are savings interest, not salary.
+- "SAL", "SALARY" or a company name on a large monthly credit is salary income.
+- Small-value repeating debits on the same day each month are usually subscriptions.
+
+Typical merchants and the kind of bucket they belong to (bucket names are
+illustrative — invent names that suit this person, but keep the grouping):
+- Food delivery & dining: Swiggy, Zomato, EatSure, Domino's, McDonald's, KFC, Starbucks,
+  Chaayos, Third Wave Coffee, Haldiram's, local tiffin rooms, darshinis, cafés, bakeries.
+- Groceries & quick commerce: Blinkit, Zepto, Swiggy Instamart, BigBasket, DMart, JioMart,
+  Reliance Fresh, More, Nature's Basket, Ratnadeep, local kirana stores.
+- Commute & travel: Ola, Uber, Rapido, Namma Yatri, BluSmart, Namma Metro, Delhi Metro,
+  Mumbai Metro, IRCTC, RedBus, MakeMyTrip, Goibibo, Cleartrip, IndiGo, Air India,
+  Akasa Air, FASTag recharges, fuel at HP, Indian Oil, Bharat Petroleum, Shell.
+- Streaming & digital subscriptions: Netflix, Amazon Prime, Disney+ Hotstar, JioCinema,
+  SonyLIV, ZEE5, Spotify, YouTube Premium, Apple Music, Apple iCloud, Google One,
+  Microsoft 365, ChatGPT, Notion, Adobe, LinkedIn Premium, Audible, Kindle Unlimited.
+- Online shopping: Amazon, Flipkart, Myntra, Ajio, Nykaa, Meesho, Tata CLiQ, Croma,
+  Reliance Digital, Decathlon, IKEA, Lenskart, FirstCry, Pepperfry, Urban Ladder.
+- Household utilities & bills: BESCOM, TANGEDCO, MSEDCL, Tata Power, Adani Electricity,
+  BWSSB, piped gas (IGL, MGL), LPG (Indane, HP Gas, Bharat Gas), Airtel, Jio, Vi, BSNL,
+  ACT Fibernet, Hathway, Tata Play, society maintenance, rent, BBMP / municipal tax.
+- Investments & savings: Zerodha, Groww, Upstox, Angel One, Kuvera, Coin, Paytm Money,
+  INDmoney, ET Money, mutual fund SIPs (CAMS, KFintech, BSE StAR MF), PPF, NPS,
+  recurring or fixed deposits, sovereign gold bonds, digital gold.
+- Insurance & protection: LIC, HDFC Life, ICICI Prudential, SBI Life, Max Life, Tata AIA,
+  Star Health, Niva Bupa, Care Health, Acko, Digit, PolicyBazaar, vehicle insurance.
+- Loans & credit: home / car / personal loan EMIs, Bajaj Finserv, HDFC / ICICI / SBI /
+  Axis credit card bill payments, CRED payments, BNPL such as Simpl, LazyPay, Slice.
+- Health & wellness: Apollo Pharmacy, MedPlus, PharmEasy, Tata 1mg, Practo, hospitals,
+  diagnostic labs, cult.fit, gyms, yoga studios.
+- Family & personal transfers: UPI or IMPS transfers to individuals, PhonePe / Google Pay /
+  Paytm person-to-person payments, remittances to parents or siblings.
+- Education: school and college fees, Byju's, Unacademy, Coursera, Udemy, coaching centres.
+- Cash: ATM withdrawals.
+- Income: salary, freelance receipts, refunds, cashback, interest, dividends.
+
+Worked examples (description → kind of bucket):
+- "UPI/412345678901/SWIGGY/HDFC" → food delivery & dining
+- "POS 4321XXXX ZEPTO MARKETPLACE" → groceries & quick commerce
+- "NACH DR ZERODHA BROKING SIP" → investments & savings
+- "ACH D- LIC OF INDIA PREMIUM" → insurance & protection
+- "IMPS/P2A/3021/AMMA" → family & personal transfers
+- "ECOM NETFLIX.COM" → streaming & digital subscriptions
+- "BILLPAY BESCOM BANGALORE" → household utilities & bills
+- "NEFT CR ACME TECHNOLOGIES SALARY OCT" → income
+- "ATM WDL MG ROAD BLR" → cash
+
+Rules:
+- Use one consistent bucket for the same merchant across the whole statement.
+- Credits that are refunds go to the bucket of the original purchase only if obvious; otherwise Income.
+- Never leave a transaction without a category.
+"""
+
+
 # ══════════════════════════════════════════════════════════════════════════════
-# STAGE 1 — PDF → PNG bytes
+# STAGE 1 — PDF → JPEG bytes
 # ══════════════════════════════════════════════════════════════════════════════
 
-def pdf_to_png_bytes(pdf_bytes: bytes) -> list[bytes]:
-    """Convert every PDF page to raw PNG bytes, purely in memory."""
-    pdf    = pdfium.PdfDocument(pdf_bytes)
-    scale  = IMAGE_DPI / 72
-    result = []
-    for page in pdf:
-        bitmap    = page.render(scale=scale, rotation=0)
-        pil_image = bitmap.to_pil()
-        buf       = io.BytesIO()
-        pil_image.save(buf, format="PNG")
-        result.append(buf.getvalue())
-        page.close()
-    pdf.close()
-    log.info(f"PDF → {len(result)} page image(s) at {IMAGE_DPI} DPI")
-    return result
+_PDFIUM_LOCK = threading.Lock()   # guards every pdfium call across threads
+
+
+def _median_font_size(page: pdfium.PdfPage) -> float:
+    """Median rendered font size in points, sampled from the page's text layer.
+
+    Uses the nominal font size scaled by each character's text matrix, not the
+    glyph box — box heights depend on which glyphs are printed, and statement
+    digits and capitals measure taller than mixed-case text of the same size.
+    Returns infinity for pages without a text layer (e.g. scanned statements).
+    Caller must hold _PDFIUM_LOCK.
+    """
+    textpage = page.get_textpage()
+    matrix   = pdfium.raw.FS_MATRIX()
+    try:
+        n_chars = textpage.count_chars()
+        step    = max(1, n_chars // 200)
+        sizes   = []
+        for i in range(0, n_chars, step):
+            size = pdfium.raw.FPDFText_GetFontSize(textpage.raw, i)
+            if size > 0 and pdfium.raw.FPDFText_GetMatrix(textpage.raw, i, matrix):
+                sizes.append(size * math.hypot(matrix.c, matrix.d))   # vertical scale of the text
+    finally:
+        textpage.close()
+    return median(sizes) if sizes else float("inf")
+
+
+def _page_scale(page: pdfium.PdfPage) -> float:
+    """Render scale for one page: IMAGE_DPI, MAX_IMAGE_DPI for fine print, capped at MAX_IMAGE_EDGE_PX."""
+    dpi = MAX_IMAGE_DPI if _median_font_size(page) <= SMALL_FONT_PT else IMAGE_DPI
+    width, height = page.get_size()   # points (1/72 inch)
+    return min(dpi / 72, MAX_IMAGE_EDGE_PX / max(width, height))
+
+
+def iter_pdf_images(pdf_bytes: bytes) -> Generator[bytes, None, None]:
+    """Yield every PDF page as raw JPEG bytes, in order, purely in memory.
+
+    JPEG rather than PNG: the pages are only read by the VLM, so lossy
+    encoding is fine and is both faster to encode and smaller to upload.
+    Pages are rendered lazily, at most one pool's worth ahead of the
+    consumer, so peak memory stays at a few page bitmaps, not the whole PDF.
+    """
+    with _PDFIUM_LOCK:
+        pdf     = pdfium.PdfDocument(pdf_bytes)
+        n_pages = len(pdf)
+
+    def _render_one(index: int) -> tuple[bytes, float]:
+        # pdfium is not thread-safe, so rasterisation is serialised;
+        # the JPEG encode (which releases the GIL) runs in parallel.
+        with _PDFIUM_LOCK:
+            page      = pdf[index]
+            scale     = _page_scale(page)
+            # RGBX byte order is what PIL uses internally, so to_pil() wraps the
+            # ctypes-owned buffer without copying or swizzling; the JPEG encoder
+            # reads RGBX directly and drops the padding byte.
+            bitmap    = page.render(scale=scale, rotation=0, rev_byteorder=True, prefer_bgrx=True)
+            pil_image = bitmap.to_pil()
+            bitmap.close()   # frees the pdfium handle only; the buffer lives on in `pil_image`
+            page.close()
+        buf = io.BytesIO()
+        pil_image.save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=False, progressive=False)
+        return buf.getvalue(), scale * 72
+
+    workers = max(1, min(n_pages, os.cpu_count() or 1))
+    pool    = ThreadPoolExecutor(max_workers=workers)
+    pending: deque[Future] = deque()
+    dpis: list[float]      = []
+    try:
+        for index in range(n_pages):
+            pending.append(pool.submit(_render_one, index))
+            if len(pending) >= workers:
+                image, dpi = pending.popleft().result()
+                dpis.append(dpi)
+                yield image
+        while pending:
+            image, dpi = pending.popleft().result()
+            dpis.append(dpi)
+            yield image
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        with _PDFIUM_LOCK:
+            pdf.close()
+
+    dpis = dpis or [0]
+    log.info(f"PDF → {n_pages} page image(s) at {min(dpis):.0f}–{max(dpis):.0f} DPI ({workers} worker(s))")
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 # STAGE 2 — VLM extraction via pydantic-ai
 # ══════════════════════════════════════════════════════════════════════════════
 
-async def extract_transactions(png_pages: list[bytes]) -> list[dict]:
-    if not GEMINI_API_KEY:
-        log.warning("No API key — returning mock transactions")
-        return _mock_transactions()
+_LLM_SEMAPHORE = asyncio.Semaphore(MAX_LLM_INFLIGHT)
+
+
+def _log_usage(stage: str, usage: Usage) -> None:
+    """Log token usage, including how much of the prompt Gemini served from its prefix cache."""
+    cached = (usage.details or {}).get("cached_content_token_count", 0)
+    log.info(f"{stage}  tokens: {usage.request_tokens} in ({cached} cached), {usage.response_tokens} out")
+
+
+# on_rows(kind, pages, rows): "rows" delivers newly extracted rows from the chunk
+# covering `pages` (first, last); "retry" withdraws every row sent for that chunk,
+# whose rows are then sent again from scratch. `pages` is None for cached results.
+RowSink = Callable[[str, Optional[tuple[int, int]], list[RawTransaction]], None]
+
+
+async def _extract_chunk(
+    pages: list[bytes],
+    first_page: int,
+    on_rows: Optional[RowSink] = None,
+) -> list[RawTransaction]:
+    """Run the extraction agent over one contiguous slice of statement pages.
+
+    The structured result is streamed; every row except the one still being
+    generated is handed to `on_rows` as soon as it is complete. Streamed rows
+    are provisional: if the final output fails validation the chunk is re-run
+    with retries, a "retry" is signalled and the re-run's rows are sent in full.
+    """
+    last_page = first_page + len(pages) - 1
 
     # pydantic-ai BinaryContent wraps raw bytes with a mime_type.
-    # Pass a list of [BinaryContent, BinaryContent, ..., str] as the user message.
-    content_parts: list = [
-        BinaryContent(data=page_bytes, media_type="image/png")
-        for page_bytes in png_pages
-    ]
-    content_parts.append(
-        f"This bank statement has {len(png_pages)} page(s). "
-        "Extract every transaction and return them in the required structured format."
+    # User message is [static str, BinaryContent, ..., BinaryContent, str]: constant
+    # text first keeps the cacheable prefix intact, per-chunk text goes last.
+    content_parts: list = [EXTRACTION_INSTRUCTIONS]
+    content_parts.extend(
+        BinaryContent(data=page_bytes, media_type="image/jpeg")
+        for page_bytes in pages
     )
+    content_parts.append(f"These are pages {first_page}–{last_page} of the statement.")
+
+    emitted = 0
+    async with _LLM_SEMAPHORE:
+        async with extraction_agent.run_stream(content_parts) as stream:
+            async for message, is_last in stream.stream_structured(debounce_by=STREAM_DEBOUNCE_S):
+                try:
+                    partial = await stream.validate_structured_result(message, allow_partial=not is_last)
+                except ValidationError:
+                    continue   # not enough JSON yet to form a valid prefix
+                done = len(partial.transactions) - 1   # last row may still be growing
+                if on_rows and done > emitted:
+                    on_rows("rows", (first_page, last_page), partial.transactions[emitted:done])
+                    emitted = done
+            try:
+                result = await stream.get_data()
+                usage  = stream.usage()
+            except ValidationError:
+                result = None
+        if result is None:
+            # run_stream() has no retry on schema-invalid output; run() sends the
+            # model a retry prompt, so redo this chunk the non-streaming way. The
+            # re-run may differ from what was streamed, so withdraw it and start over.
+            log.warning(f"Stage 1 pages {first_page}–{last_page}: invalid streamed output, retrying")
+            if on_rows and emitted:
+                on_rows("retry", (first_page, last_page), [])
+                emitted = 0
+            run    = await extraction_agent.run(content_parts)
+            result = run.data
+            usage  = run.usage()
+    _log_usage(f"Stage 1 pages {first_page}–{last_page}", usage)
+
+    if on_rows and len(result.transactions) > emitted:
+        on_rows("rows", (first_page, last_page), result.transactions[emitted:])
+    return result.transactions
+
+
+async def extract_transactions(
+    page_images: Generator[bytes, None, None], on_rows: Optional[RowSink] = None
+) -> list[RawTransaction]:
+    """Consume rendered pages as they arrive, starting an agent call per full chunk."""
+    tasks: list[asyncio.Task] = []
+    chunk: list[bytes]        = []
+    first_page = 1
+    # A cancelled to_thread() hop keeps running in its thread, so closing the
+    # generator has to wait for that page to finish rendering first.
+    stepping = threading.Lock()
+
+    def _next_page() -> Optional[bytes]:
+        with stepping:
+            return next(page_images, None)
+
+    def _close_pages() -> None:
+        with stepping:
+            page_images.close()
+
+    def _launch():
+        nonlocal chunk, first_page
+        if GEMINI_API_KEY:
+            tasks.append(asyncio.create_task(_extract_chunk(chunk, first_page, on_rows)))
+        first_page += len(chunk)
+        chunk = []
+
+    try:
+        # Rendering happens off the event loop, one page per hop, so earlier
+        # chunks are already with Gemini while later pages are still rendering.
+        while (page := await asyncio.to_thread(_next_page)) is not None:
+            chunk.append(page)
+            if len(chunk) == PAGES_PER_CHUNK:
+                _launch()
+        if chunk:
+            _launch()
+        chunks = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Run the generator's cleanup (joining the render pool, closing the
+        # document) off the event loop, instead of whenever it is collected.
+        await asyncio.to_thread(_close_pages)
+        raise
 
-    extraction_agent.model = _make_model()
-    result = await extraction_agent.run(content_parts)
+    if not GEMINI_API_KEY:
+        # Pages were still rendered above, so a broken PDF fails the same way either way
+        log.warning("No API key — returning mock transactions")
+        txns = _mock_transactions()
+        if on_rows:
+            on_rows("rows", (1, first_page - 1), txns)
+        return txns
 
-    txns = [t.model_dump() for t in result.data.transactions]
-    log.info(f"Stage 1 ✓  extracted {len(txns)} transactions")
+    txns = [t for chunk in chunks for t in chunk]
+    log.info(f"Stage 1 ✓  extracted {len(txns)} transactions from {len(chunks)} page chunk(s)")
     return txns
 
 
@@ -231,42 +547,76 @@ async def extract_transactions(png_pages: list[bytes]) -> list[dict]:
 # STAGE 3 — Classification via pydantic-ai
 # ══════════════════════════════════════════════════════════════════════════════
 
-async def classify_transactions(transactions: list[dict]) -> list[dict]:
+async def classify_transactions(transactions: list[RawTransaction]) -> list[RawTransaction]:
+    """Fill in `category` on every row, in place."""
     if not GEMINI_API_KEY:
         return _mock_classified(transactions)
 
-    # Plain text prompt — no images needed for classification
+    # Plain text prompt — no images needed for classification.
+    # Constant primer first so the prompt prefix is identical across users.
+    # Only what the classifier needs is sent: no dates, and the type folded
+    # into the sign of the amount. Categories come back keyed by row index.
     prompt = (
-        f"Here are {len(transactions)} bank transactions from an Indian account. "
+        CLASSIFICATION_PRIMER
+        + f"\nHere are {len(transactions)} bank transactions from an Indian account. "
         "Invent appropriate lifestyle categories and classify every transaction.\n\n"
-        "Transactions (JSON):\n"
-        + "\n".join(
-            f"{i+1}. {t['date']} | {t['desc']} | ₹{t['amount']} | {t['type']}"
+        "Transactions (JSON rows of [index, description, amount in ₹ — negative for debits]):\n"
+        + orjson.dumps([
+            [i, t.desc, -t.amount if t.type == "Debit" else t.amount]
             for i, t in enumerate(transactions)
-        )
+        ]).decode()
     )
 
-    classification_agent.model = _make_model()
-    result = await classification_agent.run(prompt)
-
-    classified = [t.model_dump() for t in result.data.transactions]
+    async with _LLM_SEMAPHORE:
+        result = await classification_agent.run(prompt)
+    _log_usage("Stage 2", result.usage())
+
+    assigned: set[int] = set()   # distinct rows — the model may repeat an index
+    for c in result.data.transactions:
+        if 0 <= c.idx < len(transactions):
+            transactions[c.idx].category = c.category
+            assigned.add(c.idx)
+    if len(assigned) < len(transactions):
+        log.warning(f"Stage 2: {len(transactions) - len(assigned)} transaction(s) left uncategorised")
     log.info(
-        f"Stage 2 ✓  classified {len(classified)} transactions "
+        f"Stage 2 ✓  classified {len(assigned)} transactions "
         f"into buckets: {result.data.categories_used}"
     )
-    return classified
+    return transactions
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 # STAGE 4 — Pure-Python analytics (no AI)
 # ══════════════════════════════════════════════════════════════════════════════
 
-def compute_idle_cash(transactions: list[dict]) -> dict:
-    debits  = [t for t in transactions if t["type"] == "Debit"]
-    credits = [t for t in transactions if t["type"] == "Credit"]
+# Analytics compare `type` by identity, so rows must go through
+# intern_transaction_strings() first.
+DEBIT  = sys.intern("Debit")
+CREDIT = sys.intern("Credit")
+_TYPE_CANON = {"Debit": DEBIT, "Credit": CREDIT}
+
+
+def intern_transaction_strings(transactions: list[Transaction]) -> list[Transaction]:
+    """Swap type/category for their interned copies, in place.
+
+    Parsed JSON strings are fresh objects; interned ones make the type checks
+    below single pointer comparisons and hit the identity fast path in dict lookups.
+    """
+    for t in transactions:
+        t.type = _TYPE_CANON.get(t.type, t.type)
+        if t.category:
+            t.category = sys.intern(t.category)
+    return transactions
+
+
+def compute_idle_cash(transactions: list[Transaction]) -> dict:
+    monthly_burn = total_income = 0.0
+    for t in transactions:
+        if t.type is DEBIT:
+            monthly_burn += t.amount
+        elif t.type is CREDIT:
+            total_income += t.amount
 
-    monthly_burn  = sum(t["amount"] for t in debits)
-    total_income  = sum(t["amount"] for t in credits)
     balance       = total_income - monthly_burn
     safety_buffer = balance * SAFETY_BUFFER_PCT
     surplus       = balance - safety_buffer
@@ -292,43 +642,60 @@ def compute_idle_cash(transactions: list[dict]) -> dict:
     }
 
 
-def find_subscriptions(transactions: list[dict]) -> list[dict]:
-    keywords = ("subscription", "subscriptions", "streaming", "saas")
+_SUBSCRIPTION_RE = re.compile(r"subscription|streaming|saas", re.IGNORECASE)
+
+
+def find_subscriptions(transactions: list[Transaction]) -> list[dict]:
     return [
-        {"desc": t["desc"], "amount": t["amount"], "date": t["date"]}
+        {"desc": t.desc, "amount": t.amount, "date": t.date}
         for t in transactions
-        if any(kw in t.get("category", "").lower() for kw in keywords)
+        if t.category and _SUBSCRIPTION_RE.search(t.category)
     ]
 
 
-def build_category_summary(transactions: list[dict]) -> list[dict]:
-    debits      = [t for t in transactions if t["type"] == "Debit"]
-    total_spend = sum(t["amount"] for t in debits) or 1
-    cat_totals: dict[str, list] = defaultdict(list)
-    for t in debits:
-        cat_totals[t.get("category", "Uncategorised")].append(t["amount"])
+def build_category_summary(transactions: list[Transaction]) -> list[dict]:
+    # One pass with flat float/int dicts: no per-category lists or default factories
+    totals: dict[str, float] = {}
+    counts: dict[str, int]   = {}
+    for t in transactions:
+        if t.type is DEBIT:
+            cat = t.category or "Uncategorised"
+            totals[cat] = totals.get(cat, 0.0) + t.amount
+            counts[cat] = counts.get(cat, 0) + 1
+    total_spend = sum(totals.values()) or 1
     summary = []
-    for cat, amounts in cat_totals.items():
-        total = sum(amounts)
+    for cat, total in totals.items():
         summary.append({
             "name":         cat,
             "total":        round(total, 2),
-            "count":        len(amounts),
+            "count":        counts[cat],
             "pct_of_spend": round(total / total_spend * 100, 1),
         })
     return sorted(summary, key=lambda x: x["total"], reverse=True)
 
 
-def infer_period(transactions: list[dict]) -> str:
-    dates = []
+def _parse_date(s: str) -> Optional[date]:
+    """Parse YYYY-MM-DD, slicing the string directly instead of going through strptime."""
+    try:
+        if len(s) == 10 and s[4] == "-" and s[7] == "-":
+            return date(int(s[:4]), int(s[5:7]), int(s[8:10]))
+        return datetime.strptime(s, "%Y-%m-%d").date()   # e.g. unpadded "2026-1-5"
+    except ValueError:
+        return None
+
+
+def infer_period(transactions: list[Transaction]) -> str:
+    lo = hi = None
     for t in transactions:
-        try:
-            dates.append(datetime.strptime(t["date"], "%Y-%m-%d"))
-        except Exception:
-            pass
-    if not dates:
+        d = _parse_date(t.date)
+        if d is None:
+            continue
+        if lo is None or d < lo:
+            lo = d
+        if hi is None or d > hi:
+            hi = d
+    if lo is None:
         return "Unknown period"
-    lo, hi = min(dates), max(dates)
     if lo.month == hi.month and lo.year == hi.year:
         return lo.strftime("%B %Y")
     return f"{lo.strftime('%d %b')} – {hi.strftime('%d %b %Y')}"
@@ -338,8 +705,8 @@ def infer_period(transactions: list[dict]) -> str:
 # MOCK FALLBACKS (when no API key is set)
 # ══════════════════════════════════════════════════════════════════════════════
 
-def _mock_transactions() -> list[dict]:
-    return [
+def _mock_transactions() -> list[RawTransaction]:
+    rows = [
         {"date": "2026-10-01", "desc": "Zomato Bangalore",     "amount": 685,    "type": "Debit"},
         {"date": "2026-10-02", "desc": "Salary Payout — Oct",  "amount": 100253, "type": "Credit"},
         {"date": "2026-10-03", "desc": "Varalakshi Tiffins",   "amount": 180,    "type": "Debit"},
@@ -361,40 +728,74 @@ def _mock_transactions() -> list[dict]:
         {"date": "2026-10-19", "desc": "PhonePe UPI — Mom",    "amount": 3000,   "type": "Debit"},
         {"date": "2026-10-20", "desc": "BBMP Property Tax",    "amount": 6200,   "type": "Debit"},
     ]
-
-
-def _mock_classified(transactions: list[dict]) -> list[dict]:
-    mapping = {
-        "zomato":      "Dining & Local Eats",
-        "salary":      "Income",
-        "varalakshi":  "Dining & Local Eats",
-        "zerodha":     "Investments",
-        "ola":         "Commute & Transport",
-        "youtube":     "Streaming Subscriptions",
-        "rameshwaram": "Dining & Local Eats",
-        "bescom":      "Household Utilities",
-        "amazon":      "Online Shopping",
-        "google":      "Streaming Subscriptions",
-        "metro":       "Commute & Transport",
-        "swiggy":      "Dining & Local Eats",
-        "lic":         "Insurance & Protection",
-        "spotify":     "Streaming Subscriptions",
-        "rapido":      "Commute & Transport",
-        "blinkit":     "Dining & Local Eats",
-        "groww":       "Investments",
-        "netflix":     "Streaming Subscriptions",
-        "phonepe":     "Family Remittances",
-        "bbmp":        "Household Utilities",
-    }
+    return [RawTransaction(**r) for r in rows]
+
+
+_MOCK_CATEGORY_MAP = {
+    "zomato":      "Dining & Local Eats",
+    "salary":      "Income",
+    "varalakshi":  "Dining & Local Eats",
+    "zerodha":     "Investments",
+    "ola":         "Commute & Transport",
+    "youtube":     "Streaming Subscriptions",
+    "rameshwaram": "Dining & Local Eats",
+    "bescom":      "Household Utilities",
+    "amazon":      "Online Shopping",
+    "google":      "Streaming Subscriptions",
+    "metro":       "Commute & Transport",
+    "swiggy":      "Dining & Local Eats",
+    "lic":         "Insurance & Protection",
+    "spotify":     "Streaming Subscriptions",
+    "rapido":      "Commute & Transport",
+    "blinkit":     "Dining & Local Eats",
+    "groww":       "Investments",
+    "netflix":     "Streaming Subscriptions",
+    "phonepe":     "Family Remittances",
+    "bbmp":        "Household Utilities",
+}
+
+# Single alternation over every keyword — one scan per description, leftmost hit wins
+_MOCK_CATEGORY_RE = re.compile("|".join(map(re.escape, _MOCK_CATEGORY_MAP)), re.IGNORECASE)
+
+
+def _mock_classified(transactions: list[RawTransaction]) -> list[RawTransaction]:
     for t in transactions:
-        desc_lower = t["desc"].lower()
-        t["category"] = next(
-            (cat for key, cat in mapping.items() if key in desc_lower),
-            "Miscellaneous"
-        )
+        hit = _MOCK_CATEGORY_RE.search(t.desc)
+        t.category = _MOCK_CATEGORY_MAP[hit.group().lower()] if hit else "Miscellaneous"
     return transactions
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# RESULT CACHE (opt-in — off by default to keep the zero-retention promise)
+# ══════════════════════════════════════════════════════════════════════════════
+
+# key → (stored_at, response); in memory only, oldest entries evicted first
+_RESULT_CACHE: "OrderedDict[str, tuple[float, AnalysisResponse]]" = OrderedDict()
+
+
+def _cache_key(pdf_bytes: bytes) -> str:
+    return hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+
+
+def _cache_get(key: str) -> Optional[AnalysisResponse]:
+    entry = _RESULT_CACHE.get(key)
+    if entry is None:
+        return None
+    stored_at, response = entry
+    if time.monotonic() - stored_at > RESULT_CACHE_TTL_S:
+        del _RESULT_CACHE[key]
+        return None
+    _RESULT_CACHE.move_to_end(key)
+    return response
+
+
+def _cache_put(key: str, response: AnalysisResponse) -> None:
+    _RESULT_CACHE[key] = (time.monotonic(), response)
+    _RESULT_CACHE.move_to_end(key)
+    while len(_RESULT_CACHE) > RESULT_CACHE_SIZE:
+        _RESULT_CACHE.popitem(last=False)
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # ROUTES
 # ══════════════════════════════════════════════════════════════════════════════
@@ -409,60 +810,85 @@ def health():
     }
 
 
-@app.post("/api/analyze", response_model=AnalysisResponse)
-async def analyze(file: UploadFile = File(...)):
-
-    # ── Validate ──────────────────────────────────────────────────────────────
+async def _read_pdf_upload(file: UploadFile) -> bytes:
+    """Validate the upload and return its bytes, raising the matching HTTP error."""
     if not file.filename or not file.filename.lower().endswith(".pdf"):
         raise HTTPException(
             status_code=415,
             detail="Unsupported File Format — only PDF bank statements accepted.",
         )
 
-    pdf_bytes = await file.read()
+    # Read in chunks and bail out as soon as the cap is crossed, so an oversized
+    # upload never gets buffered into memory in full.
+    limit     = MAX_PDF_SIZE_MB * 1024 * 1024
+    too_large = HTTPException(status_code=413, detail=f"File exceeds {MAX_PDF_SIZE_MB} MB limit.")
+    if file.size is not None and file.size > limit:
+        raise too_large
+    buf = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buf += chunk
+        if len(buf) > limit:
+            raise too_large
+    pdf_bytes = bytes(buf)
 
     if not pdf_bytes:
         raise HTTPException(status_code=400, detail="Uploaded file is empty.")
 
-    if len(pdf_bytes) > MAX_PDF_SIZE_MB * 1024 * 1024:
-        raise HTTPException(status_code=413, detail=f"File exceeds {MAX_PDF_SIZE_MB} MB limit.")
-
     log.info(f"▶ Received: {file.filename!r}  ({len(pdf_bytes) / 1024:.1f} KB)")
+    return pdf_bytes
 
-    try:
-        # ── 1. PDF → images ───────────────────────────────────────────────────
-        png_pages = pdf_to_png_bytes(pdf_bytes)
-
-        # ── 2. Extract transactions (pydantic-ai agent) ───────────────────────
-        raw_txns = await extract_transactions(png_pages)
-
-        if not raw_txns:
-            raise HTTPException(
-                status_code=422,
-                detail="No transactions found. Please upload a valid bank statement PDF.",
-            )
-
-        # ── 3. Classify into lifestyle buckets (pydantic-ai agent) ────────────
-        classified = await classify_transactions(raw_txns)
-
-        # ── 4. Analytics ──────────────────────────────────────────────────────
-        idle_cash  = compute_idle_cash(classified)
-        subs       = find_subscriptions(classified)
-        categories = build_category_summary(classified)
-        period     = infer_period(classified)
-
-        log.info(f"✓ Done — {len(classified)} txns, {len(categories)} buckets, "
-                 f"surplus ₹{idle_cash['investable_surplus']:,.0f}")
-
-        return AnalysisResponse(
-            transactions      = [Transaction(**t)      for t in classified],
-            categories        = [CategorySummary(**c)  for c in categories],
-            idle_cash         = IdleCash(**idle_cash),
-            subscriptions     = [SubscriptionItem(**s) for s in subs],
-            transaction_count = len(classified),
-            period            = period,
+
+async def _run_analysis(pdf_bytes: bytes, on_rows: Optional[RowSink] = None) -> AnalysisResponse:
+    """Full pipeline; `on_rows` receives extracted rows as soon as they are parsed."""
+    # ── 0. Identical upload seen recently? (only when the cache is enabled) ───
+    cache_key = _cache_key(pdf_bytes) if RESULT_CACHE_TTL_S > 0 else None
+    if cache_key and (cached := _cache_get(cache_key)) is not None:
+        log.info("✓ Cache hit — returning previous analysis of identical upload")
+        if on_rows:
+            on_rows("rows", None, cached.transactions)   # keep the row events a streaming client expects
+        return cached
+
+    # ── 1+2. PDF → images, streamed into extraction (pydantic-ai agent) ────────
+    raw_txns = await extract_transactions(iter_pdf_images(pdf_bytes), on_rows)
+
+    if not raw_txns:
+        raise HTTPException(
+            status_code=422,
+            detail="No transactions found. Please upload a valid bank statement PDF.",
         )
 
+    # ── 3. Classify into lifestyle buckets (pydantic-ai agent) ────────────────
+    classified = intern_transaction_strings(await classify_transactions(raw_txns))
+
+    # ── 4. Analytics ──────────────────────────────────────────────────────────
+    idle_cash  = compute_idle_cash(classified)
+    subs       = find_subscriptions(classified)
+    categories = build_category_summary(classified)
+    period     = infer_period(classified)
+
+    log.info(f"✓ Done — {len(classified)} txns, {len(categories)} buckets, "
+             f"surplus ₹{idle_cash['investable_surplus']:,.0f}")
+
+    response = AnalysisResponse(
+        transactions      = classified,   # already validated by the agent
+        categories        = _CATEGORY_LIST.validate_python(categories),
+        idle_cash         = IdleCash(**idle_cash),
+        subscriptions     = _SUBSCRIPTION_LIST.validate_python(subs),
+        transaction_count = len(classified),
+        period            = period,
+    )
+    if cache_key:
+        _cache_put(cache_key, response)
+    return response
+
+
+@app.post("/api/analyze", response_model=AnalysisResponse)
+async def analyze(file: UploadFile = File(...)):
+    pdf_bytes = await _read_pdf_upload(file)
+
+    try:
+        return await _run_analysis(pdf_bytes)
+
     except HTTPException:
         raise
     except Exception as e:
@@ -470,7 +896,77 @@ async def analyze(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _ndjson_line(event: dict) -> bytes:
+    return orjson.dumps(event, option=orjson.OPT_APPEND_NEWLINE)
+
+
+@app.post("/api/analyze/stream")
+async def analyze_stream(file: UploadFile = File(...)):
+    """
+    Same pipeline as /api/analyze, streamed as NDJSON:
+      {"event": "transaction", "pages": [first, last], "data": {...}}
+          one per row, as soon as it is extracted from that page chunk
+          ("pages" is null and rows arrive at once, already categorised, on a cache hit)
+      {"event": "retry",       "pages": [first, last]}
+          drop every row received for these pages; the chunk is re-extracted and resent
+      {"event": "result",      "data": {...}}   the full AnalysisResponse, last line
+      {"event": "error",       "status": ..., "detail": ...}   instead of "result" on failure
+    """
+    pdf_bytes = await _read_pdf_upload(file)
+    events: asyncio.Queue = asyncio.Queue()
+
+    def _on_rows(kind: str, pages: Optional[tuple[int, int]], rows: list[RawTransaction]) -> None:
+        # Serialise on arrival: the row objects are later categorised and interned
+        # in place, so dumping them lazily would leak that state into the events.
+        events.put_nowait((kind, {"pages": pages, "rows": [r.model_dump(mode="json") for r in rows]}))
+
+    async def _pipeline():
+        try:
+            result = await _run_analysis(pdf_bytes, on_rows=_on_rows)
+            events.put_nowait(("result", result))
+        except HTTPException as e:
+            events.put_nowait(("error", {"status": e.status_code, "detail": e.detail}))
+        except Exception as e:
+            log.exception(f"Unexpected error: {e}")
+            events.put_nowait(("error", {"status": 500, "detail": str(e)}))
+
+    async def _ndjson():
+        task = asyncio.create_task(_pipeline())
+        try:
+            while True:
+                kind, payload = await events.get()
+                if kind == "rows":
+                    for row in payload["rows"]:
+                        yield _ndjson_line({"event": "transaction", "pages": payload["pages"], "data": row})
+                elif kind == "retry":
+                    yield _ndjson_line({"event": "retry", "pages": payload["pages"]})
+                elif kind == "result":
+                    yield _ndjson_line({"event": "result", "data": payload.model_dump(mode="json")})
+                    return
+                else:
+                    yield _ndjson_line({"event": "error", **payload})
+                    return
+        finally:
+            task.cancel()   # client went away or we are done — stop any in-flight LLM calls
+
+    return StreamingResponse(_ndjson(), media_type="application/x-ndjson")
+
+
 # ─── Dev entry point ──────────────────────────────────────────────────────────
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # uvloop + httptools (both from uvicorn[standard]) pinned so a missing
+    # dependency fails loudly rather than falling back to asyncio/h11; uvloop
+    # has no Windows build, so Windows keeps the asyncio loop. WEB_CONCURRENCY > 1
+    # runs several workers (pdfium rendering is serialised per process); reload
+    # needs a single one.
+    workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=workers,
+        reload=workers == 1,
+    )